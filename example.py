@@ -43,7 +43,7 @@ def main():
     Runs through a few example uses of the connected display.
     '''
     with EPaper('/dev/ttyAMA0') as paper:
-        sleep(5)
+        paper.wait_ready()
         hello_world(paper)
         sleep(2)
 
@@ -18,15 +18,28 @@ Specifically as fetched on Nov 11, 2017.
 
 from __future__ import print_function
 
+import collections
+import logging
 import RPi.GPIO as GPIO
 import serial
 import struct
+import time
 
 
 # These correspond to the board pins used on the PI3:
 PIN_RESET = 3
 PIN_WAKEUP = 7
 
+# Seconds to hold the reset and wake up pins high for.
+PULSE_WIDTH = 0.01
+
+# Seconds to wait for the first handshake reply while waiting for the display
+# to be ready, each attempt after that waits twice as long, up to the maximum.
+POLL_FIRST = 0.01
+POLL_MAX = 0.5
+
+LOGGER = logging.getLogger(__name__)
+
 def _do_checksum(data):
     '''
     Creates a checksum by xor-ing every byte of (byte string) data.
@@ -281,6 +294,9 @@ class SetFontSize(Command):
     THIRTYTWO = b'\x01'
     FOURTYEIGHT = b'\x02'
     SIXTYFOUR = b'\x03'
+    # The height in pixels of each size, Chinese characters are as wide as
+    # they are tall, English ones half as wide.
+    PIXELS = {THIRTYTWO: 32, FOURTYEIGHT: 48, SIXTYFOUR: 64}
     def __init__(self, command, size=THIRTYTWO):
         super(SetFontSize, self).__init__(command, [size])
 
@@ -302,6 +318,24 @@ class SetZhFontSize(SetFontSize):
     def __init__(self, size=SetEnFontSize.THIRTYTWO):
         super(SetZhFontSize, self).__init__(SetZhFontSize.COMMAND, size)
 
+class DrawRectangle(Command):
+    '''
+    From the wiki:
+    Draw a rectangle according to two given points (top left and bottom
+    right corners).
+    '''
+    COMMAND = b'\x25'
+    def __init__(self, x1, y1, x2, y2):
+        super(DrawRectangle, self).__init__(self.COMMAND, struct.pack(">HHHH", x1, y1, x2, y2))
+
+class FillRectangle(DrawRectangle):
+    '''
+    From the wiki:
+    Fill a rectangle according to two given points (top left and bottom right
+    corners).
+    '''
+    COMMAND = b'\x24'
+
 class DrawCircle(Command):
     '''
     From the wiki:
@@ -343,6 +377,141 @@ class ClearScreen(Command):
 
 
 
+# Commands whose effect lasts until they're sent again, these are replayed to
+# restore the module's settings after a reset.
+STATE_COMMANDS = (SetPallet, SetEnFontSize, SetZhFontSize, SetCurrentDisplayRotation, SetStorageMode)
+
+# Commands that reply with something other than "OK", these aren't journaled.
+QUERY_COMMANDS = (ReadBaudrate, ReadStorageMode, CurrentDisplayRotation, GetPallet)
+
+class CostReport(object):
+    '''
+    Running totals of what a sequence of commands costs to send and execute,
+    as estimated by a CostModel.
+    '''
+    def __init__(self):
+        self.commands = 0
+        self.bytes = 0
+        self.wire_time = 0.0
+        self.device_time = 0.0
+        self.refreshes = 0
+
+    @property
+    def total_time(self):
+        '''
+        Estimated seconds from the first byte sent until the module is done
+        with the last command.
+        '''
+        return self.wire_time + self.device_time
+
+    def __repr__(self):
+        return u'%d commands, %d bytes, %.3fs on the wire, %.3fs processing, %d refreshes' % (
+            self.commands, self.bytes, self.wire_time, self.device_time, self.refreshes)
+
+class CostModel(object):
+    '''
+    Estimates how long commands take to reach the module and how long the
+    module then takes to process them.
+
+    The wire time comes from the baud rate (each byte is sent as 10 bits: a
+    start bit, 8 data bits and a stop bit).  The processing times are per
+    command and the defaults are rough guesses, not measurements: use
+    calibrate() to time your own module and pass the result in for better
+    estimates.
+    '''
+    BITS_PER_BYTE = 10
+
+    # The length of a frame without any data.
+    MINIMUM_FRAME = Command.HEADER_LENGTH + Command.LENGTH_LENGTH + Command.COMMAND_LENGTH + Command.FOOTER_LENGTH + Command.CHECK_LENGTH
+
+    # Seconds the module takes per command, keyed by command byte.
+    PROCESSING = {
+        RefreshAndUpdate.COMMAND: 1.5,
+        ClearScreen.COMMAND: 0.05,
+        DisplayText.COMMAND: 0.02,
+        DisplayImage.COMMAND: 0.5,
+        ImportImage.COMMAND: 60.0,
+        ImportFontLibrary.COMMAND: 60.0,
+        SetBaudrate.COMMAND: 0.1,
+    }
+
+    # Seconds the module takes for any command not listed above.
+    DEFAULT_PROCESSING = 0.005
+
+    def __init__(self, baudrate=115200, processing=None):
+        '''
+        @param baudrate The serial baud rate the commands are sent at.
+        @param processing A dictionary of command byte to seconds, overriding the default processing times.
+        '''
+        self.baudrate = baudrate
+        self.processing = dict(CostModel.PROCESSING)
+        self.processing.update(processing or {})
+
+    def add(self, report, data):
+        '''
+        Add the cost of the encoded commands in data (one or more frames as
+        returned by Command.encode()) to the report and return it.
+
+        @throws ValueError If data isn't made of whole frames.
+        '''
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            if len(data) - offset < self.MINIMUM_FRAME:
+                raise ValueError('Incomplete frame at byte %d' % offset)
+            length = struct.unpack('>H', data[offset + 1:offset + 3].tobytes())[0]
+            if length < self.MINIMUM_FRAME or offset + length > len(data):
+                raise ValueError('Bad frame length %d at byte %d' % (length, offset))
+            command = data[offset + 3:offset + 4].tobytes()
+            report.commands += 1
+            report.device_time += self.processing.get(command, self.DEFAULT_PROCESSING)
+            if command == RefreshAndUpdate.COMMAND:
+                report.refreshes += 1
+            offset += length
+        report.bytes += len(data)
+        report.wire_time += len(data) * self.BITS_PER_BYTE / float(self.baudrate)
+        return report
+
+    def estimate(self, commands):
+        '''
+        Returns a CostReport for sending the given commands in order.
+        '''
+        report = CostReport()
+        for command in commands:
+            self.add(report, command.encode())
+        return report
+
+def calibrate(paper, commands, timeout=60):
+    '''
+    Times how long the module takes to process each of the given commands
+    and returns a dictionary of command byte to seconds, for use as CostModel
+    processing times:
+
+        model = CostModel(processing=calibrate(paper, [ClearScreen(), RefreshAndUpdate()]))
+
+    Each command is sent on its own and timed until its "OK" reply, less the
+    time its bytes take on the wire.  Commands sent more than once are
+    averaged.  The commands really are sent, so the screen will change.
+
+    @param paper The EPaper to time, not in dry run mode.
+    @param commands The commands to send, queries (which don't reply "OK") can't be timed.
+    @param timeout Seconds to wait for each reply.
+    @throws IOError If a command isn't answered with "OK".
+    '''
+    times = {}
+    for command in commands:
+        data = command.encode()
+        wire_time = len(data) * CostModel.BITS_PER_BYTE / float(paper.baudrate)
+        paper.serial.flushInput()
+        start = time.time()
+        paper.write(data)
+        reply = paper.read(2, timeout)
+        elapsed = time.time() - start
+        if reply != b'OK':
+            raise IOError('Expected "OK" for %r, got %r' % (command, reply))
+        times.setdefault(command.command, []).append(max(0.0, elapsed - wire_time))
+    return dict((command, sum(elapsed) / len(elapsed)) for command, elapsed in times.items())
+
 class EPaper(object):
     '''
     This is a class to make interacting with the 4.3inch e-Paper UART Module
@@ -351,7 +520,7 @@ class EPaper(object):
     See https://www.waveshare.com/wiki/4.3inch_e-Paper_UART_Module#Serial_port
     for more info.
     '''
-    def __init__(self, port, auto=False, reset=PIN_RESET, wakeup=PIN_WAKEUP, mode=GPIO.BOARD):
+    def __init__(self, port, auto=False, reset=PIN_RESET, wakeup=PIN_WAKEUP, mode=GPIO.BOARD, dry_run=False, cost_model=None, journal=0):
         '''
         Makes an EPaper object that will read and write from the specified
         serial device (file name).
@@ -359,14 +528,43 @@ class EPaper(object):
         Note: This class makes use of the Raspberry PI GPIO functions, the
         caller should invoke GPIO.cleanup() before exiting.
 
+        In dry run mode neither the serial device nor GPIO are touched,
+        everything that would have been written is added to the cost
+        attribute (a CostReport) instead.
+
+        With a journal, commands sent since the last acknowledged refresh are
+        kept so that sync() can recover from lost or garbled commands by
+        resending only what the module didn't acknowledge.
+
         @param port The file name to open.
         @param auto Automatically update after each call.
         @param reset The GPIO pin to use for resets.
         @param wakeup The GPIO pin to use for wakeups.
         @param mode The mode of GPIO pin addressing (GPIO.BOARD is the default).
+        @param dry_run Only estimate costs, don't talk to the device.
+        @param cost_model The CostModel to estimate with (defaults to one for 115200 baud).
+        @param journal The most commands to keep for recovery, 0 disables the journal.
         '''
+        self.baudrate = 115200 # default for device
+        self.cost_model = cost_model or CostModel(self.baudrate)
+        self.cost = CostReport()
+        self.dry_run = dry_run
+        self.reset_pin = reset
+        self.wakeup_pin = wakeup
+        self.auto = auto
+
+        self.journal_size = journal
+        self.journal = collections.deque()
+        self.acknowledged = 0 # how many commands at the start of the journal the module acknowledged
+        self.truncated = False # whether commands were dropped from the journal since the last refresh
+        self.state = {} # the state commands in effect at the start of the journal, by command byte
+
+        if dry_run:
+            self.serial = None
+            return
+
         self.serial = serial.Serial(port)
-        self.serial.baudrate = 115200 # default for device
+        self.serial.baudrate = self.baudrate
         self.serial.bytesize = serial.EIGHTBITS
         self.serial.parity = serial.PARITY_NONE
 
@@ -374,10 +572,6 @@ class EPaper(object):
         GPIO.setup(reset, GPIO.OUT)
         GPIO.setup(wakeup, GPIO.OUT)
 
-        self.reset_pin = reset
-        self.wakeup_pin = wakeup
-        self.auto = auto
-
     def __enter__(self):
         '''
         So the EPaper class can be used in a with clause and
@@ -390,97 +584,233 @@ class EPaper(object):
         Invokes the GPIO.cleanup() method.  If that's not a desired behavior,
         don't use the with clause.
         '''
-        GPIO.cleanup()
+        if not self.dry_run:
+            GPIO.cleanup()
+
 
+    def _pulse(self, pin, wait, timeout):
+        '''
+        Hold a pin high for PULSE_WIDTH then set it low again, and optionally
+        wait for the display to be ready afterwards.
+        '''
+        if self.dry_run:
+            return 0.0 if wait else None
+        GPIO.output(pin, GPIO.HIGH)
+        time.sleep(PULSE_WIDTH)
+        GPIO.output(pin, GPIO.LOW)
+        if wait:
+            return self.wait_ready(timeout)
+
+    def wait_ready(self, timeout=10):
+        '''
+        Handshake with the display until it answers, starting with short
+        waits for the reply and backing off, so that drawing can start as soon
+        as the display has booted.  Returns the seconds it took, which are
+        also logged.
 
-    def reset(self):
+        @throws IOError If the display didn't answer within timeout seconds.
+        '''
+        if self.dry_run:
+            return 0.0
+        start = time.time()
+        poll = POLL_FIRST
+        while True:
+            # A short wait can cut a reply in half, throw away what's left of
+            # the last one so it isn't read as the start of the next.
+            self.serial.flushInput()
+            if self.handshake(poll):
+                break
+            if time.time() - start > timeout:
+                raise IOError('Display not ready after %s seconds' % timeout)
+            poll = min(poll * 2, POLL_MAX)
+        ready = time.time() - start
+        # Handshakes sent while booting may still be answered, don't leave
+        # those replies to be mistaken for later ones.
+        self.serial.flushInput()
+        LOGGER.info('Display ready after %.3f seconds', ready)
+        return ready
+
+    def reset(self, wait=False, timeout=10):
         '''
         Reset the display by setting the reset pin to high and then low.
+
+        @param wait Wait for the display to be ready again (see wait_ready()) and return how long it took.
+        @param timeout The most seconds to wait.
         '''
-        GPIO.output(self.reset_pin, GPIO.HIGH)
-        GPIO.output(self.reset_pin, GPIO.LOW)
+        return self._pulse(self.reset_pin, wait, timeout)
 
     def sleep(self):
         '''
         Tell the display to go to sleep.
         '''
-        self.serial.write(SleepMode().encode())
+        self.write(SleepMode().encode())
 
-    def wake(self):
+    def wake(self, wait=False, timeout=10):
         '''
         Tell the device to wake up.  It only makes sense to do this after
         telling it to sleep.
+
+        @param wait Wait for the display to be ready again (see wait_ready()) and return how long it took.
+        @param timeout The most seconds to wait.
         '''
-        GPIO.output(self.wakeup_pin, GPIO.HIGH)
-        GPIO.output(self.wakeup_pin, GPIO.LOW)
+        return self._pulse(self.wakeup_pin, wait, timeout)
 
     def update(self):
         '''
         Update the display.
         '''
-        self.serial.write(RefreshAndUpdate().encode())
+        command = RefreshAndUpdate()
+        self.write(command.encode())
+        self._record(command)
 
     def send(self, command):
         '''
         Send the provided command to the device, does not wait for a response
         or sleep or make any other considerations.
         '''
-        self.serial.write(command.encode())
+        self.write(command.encode())
+        self._record(command)
         if self.auto:
-            self.serial.write(RefreshAndUpdate().encode())
+            self.update()
+
+    def write(self, data):
+        '''
+        Write already encoded commands (one or more frames as returned by
+        Command.encode()) to the device as is.
+        '''
+        if self.dry_run:
+            self.cost_model.add(self.cost, data)
+            return
+        self.serial.write(data)
 
     def read(self, size=100, timeout=5):
         '''
-        Read a response from the underlying serial device.
+        Read a response from the underlying serial device.  In dry run mode
+        there is never anything to read.
         '''
+        if self.dry_run:
+            return b''
         self.serial.timeout = timeout
         return self.serial.read(size)
 
-if __name__ == "__main__":
-    try:
-        paper = EPaper('/dev/ttyAMA0')
-        print('Handshake')
-        paper.send(Handshake())
-        print(paper.read(2))
-        paper.send(DisplayText(10,10, u'你好, World'.encode('gb2312')))
-        print('Hello World 1')
-        print(paper.read(2))
-        print('Setting pallet to DARK_GRAY/white')
-        paper.send(SetPallet(SetPallet.DARK_GRAY))
-        print(paper.read(2))
-        paper.send(DisplayText(60, 60, u'Hello, World'.encode('utf-8')))
-        print('Hello World 2')
-        print(paper.read(2))
-        print('Setting pallet to LIGHT_GRAY/black')
-        paper.send(SetPallet(SetPallet.LIGHT_GRAY, SetPallet.BLACK))
-        print(paper.read(2))
-        paper.send(DisplayText(120, 120, u'こんにちわ, World'.encode('gb2312')))
-        print('Hello World 3')
-        print(paper.read(2))
-        print('Setting pallet to LIGHT_GRAY/white')
-        paper.send(SetPallet(SetPallet.LIGHT_GRAY))
-        print(paper.read(2))
-        paper.send(DisplayText(240, 240, u'привет, World'.encode('gb2312')))
-        print('Hello World 4')
-        print(paper.read(2))
-        paper.update()
-
-#        print(u'%s' % Handshake())
-#        print(u'%s' % SetBaudrate(9600))
-#        print(u'%s' % ReadBaudrate())
-#        print(u'%s' % ReadStorageMode())
-#        print(u'%s' % SetStorageMode(SetStorageMode.TF_MODE))
-#        print(u'%s' % SleepMode())
-#        print(u'%s' % RefreshAndUpdate())
-#        print(u'%s' % CurrentDisplayRotation())
-#        print(u'%s' % SetCurrentDisplayRotation(SetCurrentDisplayRotation.NORMAL))
-#        print(u'%s' % ImportFontLibrary())
-#        print(u'%s' % ImportImage())
-#        print(u'%s' % DisplayText(10, 10, u'你好, World'.encode('gb2312')))
-#        print(u'%s' % DisplayText(60, 60, u'Hello, World'.encode('utf-8')))
-#        print(u'%s' % DisplayText(120, 120, u'こんにちわ, World'.encode('utf-8')))
-#        print(u'%s' % SetEnFontSize(SetEnFontSize.SIXTYFOUR))
-        print(paper.read())
-
-    finally:
-        GPIO.cleanup()
+    def estimate(self, commands):
+        '''
+        Returns a CostReport for sending the given commands, without sending
+        them.  Useful for comparing different ways of drawing the same thing,
+        or checking an update will be done in time before starting it.
+        '''
+        return self.cost_model.estimate(commands)
+
+    def handshake(self, timeout=1):
+        '''
+        Returns whether the module answered a handshake with "OK" within
+        timeout seconds.
+        '''
+        if self.dry_run:
+            return True
+        self.write(Handshake().encode())
+        return self.read(2, timeout) == b'OK'
+
+    def _record(self, command):
+        '''
+        Add a sent command to the journal, dropping the oldest ones if it's
+        full.
+        '''
+        if not self.journal_size or isinstance(command, QUERY_COMMANDS):
+            return
+        self.journal.append(command)
+        while len(self.journal) > self.journal_size:
+            self._forget()
+            self.truncated = True
+
+    def _forget(self):
+        '''
+        Remove the oldest command from the journal, keeping track of the state
+        it leaves behind.
+        '''
+        command = self.journal.popleft()
+        self.acknowledged -= 1
+        if isinstance(command, STATE_COMMANDS):
+            self.state[command.command] = command
+
+    def _acknowledge(self):
+        '''
+        Mark the oldest unacknowledged command as acknowledged.  A refresh
+        being acknowledged means everything before it is on screen, so the
+        journal is emptied up to it.
+        '''
+        if self.acknowledged >= 0 and isinstance(self.journal[self.acknowledged], RefreshAndUpdate):
+            for _ in range(self.acknowledged + 1):
+                self._forget()
+            self.truncated = False
+        self.acknowledged += 1
+
+    def recover(self, timeout=1):
+        '''
+        Get back in step with the module after a missing or unexpected reply
+        and resend what it didn't acknowledge.
+
+        If the module still answers a handshake it's only the unacknowledged
+        commands that are resent.  Otherwise it's reset and everything since
+        the last refresh is resent.  Either way the settings (palette, font
+        sizes, rotation and storage mode) in effect before the first resent
+        command are restored first, later commands may have changed them.
+
+        @throws IOError If the module doesn't respond after a reset, doesn't
+        acknowledge a restored setting, or the commands needed to recover are
+        no longer in the journal.
+        '''
+        self.serial.flushInput()
+        if self.handshake(timeout) and self.acknowledged >= 0:
+            journal = list(self.journal)
+            state = dict(self.state)
+            for command in journal[:self.acknowledged]:
+                if isinstance(command, STATE_COMMANDS):
+                    state[command.command] = command
+            resend = journal[self.acknowledged:]
+        else:
+            if self.truncated:
+                raise IOError('Commands needed for recovery were dropped from the journal, redraw everything')
+            self.reset(wait=True, timeout=timeout)
+            state = self.state
+            resend = list(self.journal)
+            self.acknowledged = 0
+        for command in state.values():
+            self.write(command.encode())
+            reply = self.read(2, timeout)
+            if reply != b'OK':
+                raise IOError('Restoring %r failed, got %r' % (command, reply))
+        for command in resend:
+            self.write(command.encode())
+
+    def sync(self, timeout=5, retries=3):
+        '''
+        Wait for the module to acknowledge every journaled command, calling
+        recover() whenever a reply is missing or isn't "OK".  Without a
+        journal (or in dry run mode) this returns straight away.
+
+        Replies to queries (like ReadBaudrate) must be read before calling
+        this, or they'll be mistaken for errors.
+
+        @param timeout Seconds to wait for each reply.
+        @param retries How many times in a row to try recovering before giving up, a failed recovery counts too.
+        @throws IOError If the module couldn't be recovered.
+        '''
+        if self.dry_run:
+            return
+        failures = 0
+        error = None
+        while self.acknowledged < len(self.journal):
+            if error is None and self.read(2, timeout) == b'OK':
+                self._acknowledge()
+                failures = 0
+                continue
+            failures += 1
+            if failures > retries:
+                raise IOError('Display did not recover after %d attempts: %s' % (retries, error or 'reply missing or not "OK"'))
+            try:
+                self.recover(timeout)
+                error = None
+            except IOError as failure:
+                LOGGER.warning('Recovery failed: %s', failure)
+                error = failure
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Draw on the display from a stream of drawing operations.
+
+Reads one operation per line from stdin (or a file or FIFO) and sends them to
+the display in batches, so scripts can draw without starting Python and
+setting up the display for every command:
+
+    printf 'clear\\ntext 10 10 Hello\\ncircle 400 300 50\\n' | python -m waveshare
+
+Each line is either words separated by spaces (quoted like a shell would) or
+a JSON object with an "op" and the arguments by name:
+
+    text X Y TEXT...                {"op": "text", "x": 10, "y": 10, "text": "Hello"}
+    image X Y NAME                  {"op": "image", "x": 0, "y": 0, "name": "PIC7.BMP"}
+    circle X Y RADIUS               (fill-circle too)
+    triangle X1 Y1 X2 Y2 X3 Y3      (fill-triangle too)
+    rectangle X1 Y1 X2 Y2           (fill-rectangle too)
+    palette FG [BG]                 black, dark-gray, light-gray or white
+    font SIZE [en|zh]               32, 48 or 64, both languages by default
+    clear
+    refresh
+
+Empty lines and lines starting with # are ignored.  Nothing drawn shows up
+until a refresh, so the display is refreshed once at the end of the input
+(unless nothing was drawn or cleared since the last refresh), and commands
+are only written when a batch fills up or a refresh is asked for.
+'''
+
+#pylint: disable=line-too-long
+
+from __future__ import print_function
+
+import argparse
+import json
+import shlex
+import struct
+import sys
+
+from waveshare import ClearScreen
+from waveshare import DisplayImage
+from waveshare import DisplayText
+from waveshare import DrawCircle
+from waveshare import DrawRectangle
+from waveshare import DrawTriangle
+from waveshare import EPaper
+from waveshare import FillCircle
+from waveshare import FillRectangle
+from waveshare import FillTriangle
+from waveshare import RefreshAndUpdate
+from waveshare import SetEnFontSize
+from waveshare import SetFontSize
+from waveshare import SetPallet
+from waveshare import SetZhFontSize
+from waveshare.daemon import RenderClient
+
+# The arguments of each operation, in the order they're given on a line.
+FIELDS = {
+    'text': ('x', 'y', 'text'),
+    'image': ('x', 'y', 'name'),
+    'circle': ('x', 'y', 'radius'),
+    'fill-circle': ('x', 'y', 'radius'),
+    'triangle': ('x1', 'y1', 'x2', 'y2', 'x3', 'y3'),
+    'fill-triangle': ('x1', 'y1', 'x2', 'y2', 'x3', 'y3'),
+    'rectangle': ('x1', 'y1', 'x2', 'y2'),
+    'fill-rectangle': ('x1', 'y1', 'x2', 'y2'),
+    'palette': ('fg', 'bg'),
+    'font': ('size', 'lang'),
+    'clear': (),
+    'refresh': (),
+}
+
+SHAPES = {
+    'circle': DrawCircle,
+    'fill-circle': FillCircle,
+    'triangle': DrawTriangle,
+    'fill-triangle': FillTriangle,
+    'rectangle': DrawRectangle,
+    'fill-rectangle': FillRectangle,
+}
+
+# Commands that change what the display shows, as opposed to those that only
+# change settings like the palette or font.
+DRAWING = (DisplayText, DisplayImage, ClearScreen) + tuple(SHAPES.values())
+
+COLORS = {
+    'black': SetPallet.BLACK,
+    'dark-gray': SetPallet.DARK_GRAY,
+    'light-gray': SetPallet.LIGHT_GRAY,
+    'white': SetPallet.WHITE,
+}
+
+SIZES = dict((pixels, size) for size, pixels in SetFontSize.PIXELS.items())
+
+def parse(line):
+    '''
+    Returns the operation on a line and a list of its arguments, or None for
+    a blank line or comment.
+
+    @throws ValueError If the line can't be parsed.
+    '''
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.startswith('{'):
+        operation = json.loads(line)
+        if not isinstance(operation, dict):
+            raise ValueError('Expected a JSON object, not %r' % (operation,))
+        name = operation.get('op')
+        if not isinstance(name, type(u'')) or name not in FIELDS:
+            raise ValueError('Unknown operation %r' % name)
+        arguments = [operation.get(field) for field in FIELDS[name]]
+        while arguments and arguments[-1] is None:
+            arguments.pop()
+        return name, arguments
+    words = shlex.split(line)
+    name, arguments = words[0], words[1:]
+    if name not in FIELDS:
+        raise ValueError('Unknown operation %r' % name)
+    if name == 'text' and len(arguments) > 2:
+        arguments = arguments[:2] + [' '.join(arguments[2:])]
+    return name, arguments
+
+def _integer(value):
+    '''
+    Returns value as an integer.
+
+    @throws ValueError If value isn't a number or a string of one.
+    '''
+    try:
+        return int(value)
+    except TypeError:
+        raise ValueError('Expected a number, not %r' % (value,))
+
+def to_command(name, arguments, encoding='gb2312'):
+    '''
+    Returns the Command objects for an operation.
+
+    @throws ValueError If the arguments don't suit the operation.
+    '''
+    fields = FIELDS[name]
+    if len(arguments) > len(fields) or (name not in ('palette', 'font') and len(arguments) < len(fields)):
+        raise ValueError('%s takes %s' % (name, ' '.join(fields) or 'no arguments'))
+    if None in arguments:
+        raise ValueError('%s is missing %s' % (name, fields[arguments.index(None)]))
+    if name in ('text', 'image'):
+        text = arguments[2]
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        if not isinstance(text, type(u'')):
+            raise ValueError('Expected a string, not %r' % (text,))
+        if not text:
+            raise ValueError('%s is missing %s' % (name, fields[2]))
+        command = DisplayText if name == 'text' else DisplayImage
+        return [command(_integer(arguments[0]), _integer(arguments[1]), text.encode(encoding))]
+    if name in SHAPES:
+        return [SHAPES[name](*[_integer(_) for _ in arguments])]
+    if name == 'palette':
+        try:
+            return [SetPallet(*[COLORS[_] for _ in arguments])]
+        except (KeyError, TypeError):
+            raise ValueError('Unknown color in %r, use %s' % (arguments, ', '.join(sorted(COLORS))))
+    if name == 'font':
+        if not arguments or _integer(arguments[0]) not in SIZES:
+            raise ValueError('font takes a size of %s' % ', '.join(str(_) for _ in sorted(SIZES)))
+        size = SIZES[_integer(arguments[0])]
+        language = arguments[1] if len(arguments) > 1 else None
+        commands = []
+        if language not in (None, 'en', 'zh'):
+            raise ValueError('Unknown font language %r' % (language,))
+        if language in (None, 'en'):
+            commands.append(SetEnFontSize(size))
+        if language in (None, 'zh'):
+            commands.append(SetZhFontSize(size))
+        return commands
+    if name == 'clear':
+        return [ClearScreen()]
+    return [RefreshAndUpdate()]
+
+class Batcher(object):
+    '''
+    Collects encoded commands and writes them to the display a batch at a
+    time, refreshing only when something was drawn since the last refresh.
+    '''
+
+    def __init__(self, paper, size=64):
+        '''
+        @param paper What to write to, anything with write and update methods (like EPaper or RenderClient).
+        @param size How many commands to collect before writing them.
+        '''
+        self.paper = paper
+        self.size = size
+        self.pending = []
+        self.changed = False
+
+    def add(self, command):
+        '''
+        Add a command, writing the batch if it's full.  Refreshes write the
+        batch and refresh straight away.
+        '''
+        if isinstance(command, RefreshAndUpdate):
+            self.refresh()
+            return
+        self.pending.append(command.encode())
+        if isinstance(command, DRAWING):
+            self.changed = True
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write any pending commands.
+        '''
+        if self.pending:
+            self.paper.write(b''.join(self.pending))
+            self.pending = []
+
+    def refresh(self):
+        '''
+        Write any pending commands and refresh, if anything changed since the
+        last refresh.
+        '''
+        self.flush()
+        if self.changed:
+            self.paper.update()
+            self.changed = False
+
+def main(argv=None):
+    '''
+    Read operations from the input and draw them on the display, returning
+    the exit status (1 if any lines were rejected).
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0].strip(), epilog=__doc__.split('\n\n', 1)[1], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', help='file or FIFO to read from (default stdin)')
+    parser.add_argument('--port', default='/dev/ttyAMA0', help='serial device of the display')
+    parser.add_argument('--socket', help='send to the render daemon listening here instead of opening the display')
+    parser.add_argument('--batch', default=64, type=int, help='commands to write at a time')
+    parser.add_argument('--encoding', default='gb2312', help='encoding of text for the display')
+    parser.add_argument('--wait', action='store_true', help='wait for the display to be ready first')
+    parser.add_argument('--no-refresh', action='store_true', help="don't refresh at the end of the input")
+    parser.add_argument('--dry-run', action='store_true', help="don't open the display, print what sending would cost")
+    args = parser.parse_args(argv)
+
+    stream = open(args.input) if args.input else sys.stdin
+    if args.socket:
+        paper = RenderClient(args.socket)
+    else:
+        paper = EPaper(args.port, dry_run=args.dry_run)
+    status = 0
+    with paper:
+        if args.wait and not args.socket:
+            paper.wait_ready()
+        batcher = Batcher(paper, args.batch)
+        # readline rather than iterating, which would read ahead and leave
+        # lines from a FIFO waiting in a buffer.
+        for number, line in enumerate(iter(stream.readline, ''), 1):
+            try:
+                operation = parse(line)
+                if operation:
+                    for command in to_command(*operation, encoding=args.encoding):
+                        batcher.add(command)
+            except (ValueError, UnicodeError, struct.error) as error:
+                print('line %d: %s' % (number, error), file=sys.stderr)
+                status = 1
+        if args.no_refresh:
+            batcher.flush()
+        else:
+            batcher.refresh()
+        if args.dry_run and not args.socket:
+            print(paper.cost, file=sys.stderr)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
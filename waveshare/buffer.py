@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Compact storage for long lists of drawing commands.
+
+A Command object per primitive is convenient, but costs a Python object, an
+instance dictionary and a separate string for its data.  CommandBuffer keeps
+the same information in a handful of flat arrays instead:
+
+* the command byte of every command,
+* every command's complete frame, checksum included, one after the other in
+  a shared bytearray, and the offset of each frame in it,
+* a bounding box (x1, y1, x2, y2) for every command.
+
+Commands are added with methods named after what they draw, which write
+straight into the arrays without creating any objects.  Since the frames are
+already encoded, encoding the buffer (or any run of commands in it) is just a
+view of the bytearray, ready to be written to the display without copying.
+'''
+
+#pylint: disable=line-too-long
+
+import array
+import functools
+import operator
+import struct
+
+from waveshare import ClearScreen
+from waveshare import Command
+from waveshare import DisplayImage
+from waveshare import DisplayText
+from waveshare import DrawCircle
+from waveshare import DrawRectangle
+from waveshare import DrawTriangle
+from waveshare import FillCircle
+from waveshare import FillRectangle
+from waveshare import FillTriangle
+from waveshare import RefreshAndUpdate
+from waveshare import SetFontSize
+from waveshare import SetPallet
+
+# Bytes in a frame before the data (header, length, command) and after it
+# (footer, checksum).
+FRAME_PREFIX = Command.HEADER_LENGTH + Command.LENGTH_LENGTH + Command.COMMAND_LENGTH
+FRAME_SUFFIX = Command.FOOTER_LENGTH + Command.CHECK_LENGTH
+FRAME_OVERHEAD = FRAME_PREFIX + FRAME_SUFFIX
+
+# The checksum of the parts of a frame every command has in common, the length
+# and command byte are added per command.
+COMMON_CHECKSUM = functools.reduce(operator.xor, bytearray(Command.FRAME_HEADER + Command.FRAME_FOOTER), 0)
+
+# The bounding box of commands that don't draw anything, its left edge is past
+# its right so it can't be mistaken for a real box (even one at the origin).
+NO_BOX = (0xffff, 0xffff, 0, 0)
+NO_BOX_ARRAY = array.array('H', NO_BOX)
+
+def _xor(data):
+    '''
+    Returns the xor of every byte of data, as a number.
+    '''
+    return functools.reduce(operator.xor, bytearray(data), 0)
+
+class CommandView(object):
+    '''
+    A lightweight reference to one command in a CommandBuffer.  Views are
+    only made when a command is looked up, and read from the buffer's arrays.
+    '''
+    __slots__ = ('buffer', 'index')
+
+    def __init__(self, buffer, index):
+        self.buffer = buffer
+        self.index = index
+
+    @property
+    def command(self):
+        '''
+        The command byte, as in Command.command.
+        '''
+        return chr(self.buffer.commands[self.index])
+
+    @property
+    def data(self):
+        '''
+        A memoryview of the command's data (what Command.convert_bytes()
+        returns), without copying it.
+        '''
+        offsets = self.buffer.offsets
+        return memoryview(self.buffer.data)[offsets[self.index] + FRAME_PREFIX:offsets[self.index + 1] - FRAME_SUFFIX]
+
+    @property
+    def bbox(self):
+        '''
+        The (x1, y1, x2, y2) bounding box of what the command draws, None
+        for commands that don't draw anything.
+        '''
+        start = self.index * 4
+        box = tuple(self.buffer.boxes[start:start + 4])
+        return None if box == NO_BOX else box
+
+    def encode(self):
+        '''
+        Encodes just this command, the same as Command.encode() would.
+        '''
+        return self.buffer.encode(self.index, self.index + 1)
+
+    def __repr__(self):
+        return u' '.join([u'%02x' % b for b in bytearray(self.encode())])
+
+class CommandBuffer(object):
+    '''
+    A display list of commands stored as flat arrays.  For example:
+
+        commands = CommandBuffer()
+        commands.clear()
+        for x in range(0, 800, 10):
+            commands.circle(x, 300, 5)
+        commands.refresh()
+        paper.write(commands.encode())
+    '''
+
+    def __init__(self):
+        self.commands = array.array('B')
+        self.offsets = array.array('L', [0])
+        self.boxes = array.array('H')
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('CommandBuffer index out of range')
+        return CommandView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield CommandView(self, index)
+
+    def add(self, command, data=b'', bbox=NO_BOX):
+        '''
+        Add a command from its command byte and data.
+
+        @param command The command byte (as in Command.COMMAND).
+        @param data The command's data as a string of bytes.
+        @param bbox The (x1, y1, x2, y2) box it draws in, negative coordinates are clamped to 0.
+        '''
+        length = len(data) + FRAME_OVERHEAD
+        self.commands.append(ord(command))
+        self.data.extend(Command.FRAME_HEADER)
+        self.data.extend(struct.pack('>H', length))
+        self.data.extend(command)
+        self.data.extend(data)
+        self.data.extend(Command.FRAME_FOOTER)
+        self.data.append(COMMON_CHECKSUM ^ (length >> 8) ^ (length & 0xff) ^ ord(command) ^ _xor(data))
+        self.offsets.append(len(self.data))
+        self.boxes.extend([max(0, _) for _ in bbox])
+
+    def append(self, command, size=SetFontSize.THIRTYTWO):
+        '''
+        Add an existing Command object.  Drawing commands get the same
+        bounding box as when added with the method named after what they
+        draw.
+
+        @param size The English font size DisplayText is drawn in, as for text().
+        '''
+        data = command.convert_bytes()
+        if isinstance(command, DisplayText):
+            x, y = struct.unpack('>HH', data[:4])
+            if isinstance(command, DisplayImage):
+                self.image(x, y, data[4:-1])
+            else:
+                self.text(x, y, data[4:-1], size)
+        elif isinstance(command, DrawRectangle):
+            self.rectangle(*struct.unpack('>HHHH', data), fill=isinstance(command, FillRectangle))
+        elif isinstance(command, DrawCircle):
+            self.circle(*struct.unpack('>HHH', data), fill=isinstance(command, FillCircle))
+        elif isinstance(command, DrawTriangle):
+            self.triangle(*struct.unpack('>HHHHHH', data), fill=isinstance(command, FillTriangle))
+        else:
+            self.add(command.command, data)
+
+    def extend(self, commands):
+        '''
+        Add every Command object in commands.
+        '''
+        for command in commands:
+            self.append(command)
+
+    def text(self, x, y, text, size=SetFontSize.THIRTYTWO):
+        '''
+        Add a DisplayText.  The text must be GB2312 encoded, where every byte
+        is half the font size wide, which gives the bounding box.
+        '''
+        pixels = SetFontSize.PIXELS[size]
+        self.add(DisplayText.COMMAND, struct.pack('>HH', x, y) + text + b'\x00', (x, y, x + len(text) * pixels // 2 - 1, y + pixels - 1))
+
+    def image(self, x, y, name):
+        '''
+        Add a DisplayImage.  The image size isn't known so the bounding box is
+        just its top left corner.
+        '''
+        self.add(DisplayImage.COMMAND, struct.pack('>HH', x, y) + name + b'\x00', (x, y, x, y))
+
+    def rectangle(self, x1, y1, x2, y2, fill=False):
+        '''
+        Add a DrawRectangle, or a FillRectangle when fill is set.
+        '''
+        command = FillRectangle.COMMAND if fill else DrawRectangle.COMMAND
+        self.add(command, struct.pack('>HHHH', x1, y1, x2, y2), (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+
+    def circle(self, x, y, radius, fill=False):
+        '''
+        Add a DrawCircle, or a FillCircle when fill is set.
+        '''
+        command = FillCircle.COMMAND if fill else DrawCircle.COMMAND
+        self.add(command, struct.pack('>HHH', x, y, radius), (x - radius, y - radius, x + radius, y + radius))
+
+    def triangle(self, x1, y1, x2, y2, x3, y3, fill=False):
+        '''
+        Add a DrawTriangle, or a FillTriangle when fill is set.
+        '''
+        command = FillTriangle.COMMAND if fill else DrawTriangle.COMMAND
+        self.add(command, struct.pack('>HHHHHH', x1, y1, x2, y2, x3, y3), (min(x1, x2, x3), min(y1, y2, y3), max(x1, x2, x3), max(y1, y2, y3)))
+
+    def pallet(self, fg=SetPallet.BLACK, bg=SetPallet.WHITE):
+        '''
+        Add a SetPallet.
+        '''
+        self.add(SetPallet.COMMAND, fg + bg)
+
+    def clear(self):
+        '''
+        Add a ClearScreen.
+        '''
+        self.add(ClearScreen.COMMAND)
+
+    def refresh(self):
+        '''
+        Add a RefreshAndUpdate.
+        '''
+        self.add(RefreshAndUpdate.COMMAND)
+
+    def intersecting(self, x1, y1, x2, y2):
+        '''
+        Returns the indexes of the drawing commands whose bounding boxes
+        overlap the given box.
+        '''
+        boxes = self.boxes
+        found = []
+        for index in range(len(self)):
+            start = index * 4
+            if boxes[start:start + 4] == NO_BOX_ARRAY:
+                continue
+            if boxes[start] <= x2 and boxes[start + 2] >= x1 and boxes[start + 1] <= y2 and boxes[start + 3] >= y1:
+                found.append(index)
+        return found
+
+    def encode(self, start=0, end=None):
+        '''
+        Encodes the commands from start up to (not including) end, the same
+        as joining what Command.encode() returns for each of them.  The frames
+        are stored encoded, so this is a memoryview of them rather than a
+        copy.  The buffer can't grow while a view of it is held, so let go of
+        it (or copy it with bytes()) before adding more commands.
+        '''
+        end = len(self) if end is None else end
+        return memoryview(self.data)[self.offsets[start]:self.offsets[end]]
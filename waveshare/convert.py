@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Converts images into bitmaps the display can show with DisplayImage.
+
+The display only shows its own four gray levels (the SetPallet colors) and
+needs bitmaps named with at most 10 uppercase characters.  This module
+resizes any image (a file, a PIL image or a NumPy array) to fit the 800x600
+screen, dithers it down to those four levels and writes it as a 2 bit per
+pixel BMP into a staging directory, ready to be copied to the TF card and
+loaded with ImportImage.
+
+Bitmaps are named after a hash of the source and the conversion options, so
+converting the same image again just returns the existing file.
+
+This needs NumPy and PIL (Pillow), which the rest of the package doesn't:
+
+    pip install --user numpy pillow
+'''
+
+#pylint: disable=line-too-long
+
+from __future__ import print_function
+
+import argparse
+import functools
+import hashlib
+import multiprocessing
+import os
+import struct
+import tempfile
+
+import numpy
+from PIL import Image
+
+WIDTH = 800
+HEIGHT = 600
+
+# The gray value of each SetPallet color, in palette order: black, dark gray,
+# light gray and white.
+GRAYS = (0x00, 0x55, 0xaa, 0xff)
+
+ORDERED = 'ordered'
+DIFFUSION = 'diffusion'
+
+# 4x4 Bayer threshold map, scaled to offsets between -0.5 and 0.5 of a gray
+# level.
+BAYER = (numpy.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5],
+]) + 0.5) / 16.0 - 0.5
+
+NAME_LENGTH = 6 # characters before the .BMP, keeping names under 11 with the ending 0
+NAME_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+def load(source):
+    '''
+    Returns the source (a file name, a PIL image or a NumPy array) as a PIL
+    grayscale image.
+    '''
+    if isinstance(source, numpy.ndarray):
+        source = Image.fromarray(source.astype(numpy.uint8))
+    elif not isinstance(source, Image.Image):
+        source = Image.open(source)
+    return source.convert('L')
+
+def fit(image):
+    '''
+    Scale a grayscale image to fit the screen, keeping its aspect ratio and
+    centering it on white.  SetCurrentDisplayRotation only ever turns the
+    screen 180°, which the display applies to everything it draws, so the
+    size is the same either way and the image is left upright.
+    '''
+    scale = min(WIDTH / float(image.size[0]), HEIGHT / float(image.size[1]))
+    size = (max(1, int(round(image.size[0] * scale))), max(1, int(round(image.size[1] * scale))))
+    screen = Image.new('L', (WIDTH, HEIGHT), GRAYS[-1])
+    screen.paste(image.resize(size, Image.LANCZOS), ((WIDTH - size[0]) // 2, (HEIGHT - size[1]) // 2))
+    return screen
+
+def dither_ordered(gray):
+    '''
+    Returns the palette index (0-3) of every pixel of a 2D array of gray
+    values, using ordered (Bayer) dithering.  Every pixel is independent, so
+    this is done for the whole image at once.
+    '''
+    height, width = gray.shape
+    thresholds = numpy.tile(BAYER, (height // 4 + 1, width // 4 + 1))[:height, :width]
+    levels = gray * ((len(GRAYS) - 1) / 255.0) + thresholds
+    return numpy.clip(numpy.rint(levels), 0, len(GRAYS) - 1).astype(numpy.uint8)
+
+def dither_diffusion(gray):
+    '''
+    Returns the palette index (0-3) of every pixel of a 2D array of gray
+    values, using Floyd-Steinberg error diffusion.  The error carried down to
+    the next row is added a row at a time, but each pixel depends on the one
+    before it, so the pixels within a row are handled one after the other.
+    '''
+    height, width = gray.shape
+    top = len(GRAYS) - 1
+    levels = gray * (top / 255.0)
+    indexes = numpy.empty((height, width), numpy.uint8)
+    below = numpy.zeros(width + 2)
+    for y in range(height):
+        row = (levels[y] + below[1:-1]).tolist()
+        spread = [0.0] * (width + 2)
+        output = [0] * width
+        carry = 0.0
+        for x in range(width):
+            value = row[x] + carry
+            index = min(top, max(0, int(value + 0.5)))
+            error = value - index
+            output[x] = index
+            carry = error * 7 / 16.0
+            spread[x] += error * 3 / 16.0
+            spread[x + 1] += error * 5 / 16.0
+            spread[x + 2] += error / 16.0
+        indexes[y] = output
+        below = numpy.array(spread)
+    return indexes
+
+DITHERS = {ORDERED: dither_ordered, DIFFUSION: dither_diffusion}
+
+def write_bmp(indexes, path):
+    '''
+    Write a 2D array of palette indexes (0-3) to path as a 2 bit per pixel
+    BMP with the four display grays as its palette.
+    '''
+    height, width = indexes.shape
+    row_bytes = (width * 2 + 31) // 32 * 4
+    padded = numpy.zeros((height, row_bytes * 4), numpy.uint8)
+    padded[:, :width] = indexes
+    quads = padded.reshape(height, row_bytes, 4)
+    packed = (quads[:, :, 0] << 6) | (quads[:, :, 1] << 4) | (quads[:, :, 2] << 2) | quads[:, :, 3]
+    pixels = packed[::-1].astype(numpy.uint8).tobytes() # BMP rows go bottom up
+    palette = b''.join([struct.pack('<BBBB', gray, gray, gray, 0) for gray in GRAYS])
+    offset = 14 + 40 + len(palette)
+    with open(path, 'wb') as output:
+        output.write(struct.pack('<2sIHHI', b'BM', offset + len(pixels), 0, 0, offset))
+        output.write(struct.pack('<IiiHHIIiiII', 40, width, height, 1, 2, 0, len(pixels), 2835, 2835, len(GRAYS), len(GRAYS)))
+        output.write(palette)
+        output.write(pixels)
+
+def fingerprint(source, method):
+    '''
+    Returns a hash of the source image content and the conversion options.
+    '''
+    digest = hashlib.sha1()
+    if isinstance(source, numpy.ndarray):
+        digest.update(repr((source.shape, source.dtype.str)).encode('ascii'))
+        digest.update(numpy.ascontiguousarray(source).tobytes())
+    elif isinstance(source, Image.Image):
+        digest.update(repr((source.size, source.mode)).encode('ascii'))
+        digest.update(source.tobytes())
+    else:
+        with open(source, 'rb') as image:
+            for chunk in iter(functools.partial(image.read, 65536), b''):
+                digest.update(chunk)
+    digest.update(repr((method, WIDTH, HEIGHT)).encode('ascii'))
+    return digest.hexdigest()
+
+def bitmap_name(fingerprint_hex):
+    '''
+    Returns a bitmap name the display accepts (uppercase, under 11
+    characters with the ending 0) made from a hex fingerprint.
+    '''
+    number = int(fingerprint_hex, 16)
+    name = ''
+    for _ in range(NAME_LENGTH):
+        number, digit = divmod(number, len(NAME_DIGITS))
+        name += NAME_DIGITS[digit]
+    return name + '.BMP'
+
+def convert(source, staging, method=ORDERED):
+    '''
+    Convert one image into a bitmap in the staging directory and return its
+    name, for use with DisplayImage.  If the bitmap was already made from the
+    same source and options it is reused.
+
+    @param source A file name, PIL image or NumPy array.
+    @param staging The directory to write bitmaps to.
+    @param method ORDERED or DIFFUSION dithering.
+    '''
+    name = bitmap_name(fingerprint(source, method))
+    path = os.path.join(staging, name)
+    if not os.path.exists(path):
+        gray = numpy.asarray(fit(load(source)), dtype=numpy.float64)
+        # Another process may be converting the same image, each writes its
+        # own file and renames it into place, the last rename wins.
+        handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=staging)
+        os.close(handle)
+        try:
+            write_bmp(DITHERS[method](gray), temporary)
+            os.rename(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+    return name
+
+def convert_batch(sources, staging, method=ORDERED, processes=None):
+    '''
+    Convert many images at once, spread over a pool of processes (one per CPU
+    by default).  Returns the bitmap names in the same order as sources.
+    '''
+    if not os.path.isdir(staging):
+        os.makedirs(staging)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(functools.partial(convert, staging=staging, method=method), sources)
+    finally:
+        pool.close()
+        pool.join()
+
+def main():
+    '''
+    Convert the images named on the command line into the staging directory.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0].strip())
+    parser.add_argument('staging', help='directory to write bitmaps to')
+    parser.add_argument('images', nargs='+', help='images to convert')
+    parser.add_argument('--method', choices=sorted(DITHERS), default=ORDERED, help='dithering method')
+    args = parser.parse_args()
+    for image, name in zip(args.images, convert_batch(args.images, args.staging, args.method)):
+        print('%s %s' % (name, image))
+
+if __name__ == "__main__":
+    main()
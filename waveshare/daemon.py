@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Render daemon for sharing one e-Paper module between many processes.
+
+Only one process can sensibly own the serial port and GPIO pins of the
+display, so this module provides a daemon that holds the EPaper object and
+accepts drawing commands from any number of clients over a Unix domain
+socket.
+
+The protocol is the display's own: clients write encoded Command frames
+(exactly what Command.encode() returns) to the socket, back to back.  The
+frames are self delimiting, so no additional framing is needed and any
+Command subclass can be sent without the daemon knowing about it.
+
+Frames that arrive within a short window are collected into a batch:
+
+* A drawing command identical to one still waiting in the batch replaces it,
+  since drawing the same thing again covers it anyway, unless the font size,
+  storage mode or rotation changed in between (the same text in another font
+  size, or the same image name from another storage, draws something else).
+  Anything else is kept: text at the same position, for example, may be
+  shorter than what it follows and not cover all of it.
+* Drawing commands followed by a ClearScreen are dropped.
+* RefreshAndUpdate frames are not forwarded as they arrive, instead a single
+  refresh is sent after the batch is written.
+
+Writes to the display only ever happen from the daemon's single loop, so
+commands from different clients are never interleaved mid-frame.  The
+palette, font sizes, storage mode and rotation are shared by everyone though,
+so the daemon remembers the last of each that every client set and sends a
+client's settings again before its drawing whenever another client wrote in
+between.
+'''
+
+#pylint: disable=line-too-long
+
+from __future__ import print_function
+
+import argparse
+import errno
+import os
+import select
+import socket
+import struct
+import time
+
+from waveshare import ClearScreen
+from waveshare import Command
+from waveshare import DisplayImage
+from waveshare import DisplayText
+from waveshare import DrawCircle
+from waveshare import DrawRectangle
+from waveshare import DrawTriangle
+from waveshare import EPaper
+from waveshare import FillCircle
+from waveshare import FillRectangle
+from waveshare import FillTriangle
+from waveshare import RefreshAndUpdate
+from waveshare import SetCurrentDisplayRotation
+from waveshare import SetEnFontSize
+from waveshare import SetPallet
+from waveshare import SetStorageMode
+from waveshare import SetZhFontSize
+from waveshare import _do_checksum
+
+# Commands that draw something, as opposed to those that change state.
+DRAWING = (
+    DisplayText.COMMAND, DisplayImage.COMMAND,
+    b'\x20', b'\x22', # point, line
+    DrawRectangle.COMMAND, FillRectangle.COMMAND,
+    DrawCircle.COMMAND, FillCircle.COMMAND,
+    DrawTriangle.COMMAND, FillTriangle.COMMAND,
+)
+
+# State commands that change what a drawing command draws, rather than just
+# its colors, so a copy of it sent after one of these doesn't cover the one
+# sent before.
+RESHAPING = (
+    SetEnFontSize.COMMAND, SetZhFontSize.COMMAND,
+    SetStorageMode.COMMAND, SetCurrentDisplayRotation.COMMAND,
+)
+
+# State commands each client's own settings are kept for.
+STATE = (SetPallet.COMMAND,) + RESHAPING
+
+MINIMUM_FRAME = Command.HEADER_LENGTH + Command.LENGTH_LENGTH + Command.COMMAND_LENGTH + Command.FOOTER_LENGTH + Command.CHECK_LENGTH
+
+# Nothing the display accepts comes close to this, anything longer is noise.
+MAXIMUM_FRAME = 1024
+
+DEFAULT_SOCKET = '/tmp/waveshare.sock'
+
+class FrameParser(object):
+    '''
+    Splits a stream of bytes from a client into the individual frames it
+    contains.  Bytes that can't be part of a valid frame are discarded so a
+    misbehaving client can't wedge the stream.
+    '''
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        '''
+        Add data to the buffer and return a list of all the complete frames
+        now available.
+        '''
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(Command.FRAME_HEADER)
+            if start < 0:
+                self.buffer = b''
+                break
+            self.buffer = self.buffer[start:]
+            if len(self.buffer) < Command.HEADER_LENGTH + Command.LENGTH_LENGTH:
+                break
+            length = struct.unpack('>H', self.buffer[1:3])[0]
+            if length < MINIMUM_FRAME or length > MAXIMUM_FRAME:
+                self.buffer = self.buffer[1:]
+                continue
+            if len(self.buffer) < length:
+                break
+            frame = self.buffer[:length]
+            if frame[-5:-1] != Command.FRAME_FOOTER or _do_checksum(frame[:-1]) != frame[-1:]:
+                self.buffer = self.buffer[1:]
+                continue
+            frames.append(frame)
+            self.buffer = self.buffer[length:]
+        return frames
+
+def frame_command(frame):
+    '''
+    Returns the command byte of an encoded frame.
+    '''
+    return frame[3:4]
+
+class RenderQueue(object):
+    '''
+    Collects frames for the next batch, dropping the ones that are certain to
+    be drawn over anyway.
+    '''
+
+    def __init__(self):
+        self.frames = []
+        self.refresh = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, frame):
+        '''
+        Add an encoded frame to the batch.
+        '''
+        command = frame_command(frame)
+        if command == RefreshAndUpdate.COMMAND:
+            self.refresh = True
+            return
+        if command == ClearScreen.COMMAND:
+            self.frames = [_ for _ in self.frames if frame_command(_) not in DRAWING]
+        elif command in DRAWING:
+            for index in range(len(self.frames) - 1, -1, -1):
+                if frame_command(self.frames[index]) in RESHAPING:
+                    break
+                if self.frames[index] == frame:
+                    del self.frames[index]
+                    break
+        self.frames.append(frame)
+
+    def drain(self):
+        '''
+        Returns the batch as one string of bytes, whether a refresh was
+        requested, and empties the queue.
+        '''
+        data, refresh = b''.join(self.frames), self.refresh
+        self.frames = []
+        self.refresh = False
+        return data, refresh
+
+class RenderDaemon(object):
+    '''
+    Owns an EPaper and serves drawing requests sent to a Unix domain socket.
+    '''
+
+    def __init__(self, paper, path=DEFAULT_SOCKET, delay=0.25):
+        '''
+        @param paper The EPaper to draw on, the daemon should be its only user.
+        @param path The file name of the socket to listen on.
+        @param delay Seconds to collect frames for after the first one of a batch arrives.
+        '''
+        self.paper = paper
+        self.path = path
+        self.delay = delay
+        self.queue = RenderQueue()
+        self.deadline = None
+        self.listener = None
+        self.clients = {}
+        self.states = {}
+        self.writer = None
+
+    def listen(self):
+        '''
+        Create the listening socket, replacing a stale socket file if there is
+        one.
+        '''
+        try:
+            os.unlink(self.path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(16)
+
+    def close(self):
+        '''
+        Write anything still queued, then close every socket and remove the
+        socket file.
+        '''
+        self.flush()
+        for client in list(self.clients):
+            client.close()
+        self.clients = {}
+        self.states = {}
+        self.writer = None
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+            os.unlink(self.path)
+
+    def flush(self):
+        '''
+        Write the queued frames to the display, followed by a single refresh
+        if any client asked for one.
+        '''
+        self.deadline = None
+        data, refresh = self.queue.drain()
+        if data:
+            self.paper.write(data)
+        if refresh:
+            self.paper.update()
+
+    def _queue(self, client, frame):
+        '''
+        Queue a frame from a client.  State frames are remembered as the
+        client's settings, and those are queued again before its drawing if
+        another client wrote since.
+        '''
+        command = frame_command(frame)
+        state = self.states.setdefault(client, {})
+        if command in STATE:
+            state[command] = frame
+            self.writer = client
+        elif command in DRAWING or command == ClearScreen.COMMAND:
+            if self.writer is not None and self.writer is not client:
+                for saved in sorted(state):
+                    self.queue.add(state[saved])
+            self.writer = client
+        self.queue.add(frame)
+
+    def _receive(self, client):
+        '''
+        Read whatever a client sent and queue the frames in it.  A client
+        that disconnected, cleanly or not, is dropped.
+        '''
+        try:
+            data = client.recv(4096)
+        except socket.error:
+            data = b''
+        if not data:
+            client.close()
+            del self.clients[client]
+            self.states.pop(client, None)
+            return
+        for frame in self.clients[client].feed(data):
+            self._queue(client, frame)
+            if self.deadline is None:
+                self.deadline = time.time() + self.delay
+
+    def serve_once(self, timeout=None):
+        '''
+        Wait for one round of socket activity (or the batch deadline) and
+        handle it.
+        '''
+        if self.deadline is not None:
+            remaining = max(0, self.deadline - time.time())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        readable, _, _ = select.select([self.listener] + list(self.clients), [], [], timeout)
+        for ready in readable:
+            if ready is self.listener:
+                client, _ = self.listener.accept()
+                self.clients[client] = FrameParser()
+            else:
+                self._receive(ready)
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.flush()
+
+    def serve_forever(self):
+        '''
+        Listen on the socket and handle requests until interrupted.
+        '''
+        self.listen()
+        try:
+            while True:
+                self.serve_once()
+        finally:
+            self.close()
+
+class RenderClient(object):
+    '''
+    Sends commands to a RenderDaemon, it can be used in place of an EPaper for
+    drawing.
+    '''
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Disconnect from the daemon.
+        '''
+        self.socket.close()
+
+    def send(self, command):
+        '''
+        Send the provided command to the daemon.
+        '''
+        self.write(command.encode())
+
+    def write(self, data):
+        '''
+        Send already encoded commands (one or more frames as returned by
+        Command.encode()) to the daemon.
+        '''
+        self.socket.sendall(data)
+
+    def update(self):
+        '''
+        Ask the daemon to refresh the display after its current batch.
+        '''
+        self.send(RefreshAndUpdate())
+
+def main():
+    '''
+    Run the render daemon on the given serial device and socket path.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0].strip())
+    parser.add_argument('--port', default='/dev/ttyAMA0', help='serial device of the display')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='path of the socket to listen on')
+    parser.add_argument('--delay', default=0.25, type=float, help='seconds to collect a batch for')
+    args = parser.parse_args()
+    with EPaper(args.port) as paper:
+        try:
+            RenderDaemon(paper, args.socket, args.delay).serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
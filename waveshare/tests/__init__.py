@@ -14,6 +14,14 @@ so no display needs to be hooked up.
 # generally too long, so squash those errors:
 # pylint: disable=line-too-long
 
+import errno
+import os
+import re
+import shutil
+import socket
+import struct
+import tempfile
+import time
 import unittest
 from waveshare import Handshake
 from waveshare import SetBaudrate
@@ -33,6 +41,26 @@ from waveshare import FillTriangle
 from waveshare import ClearScreen
 from waveshare import DisplayText
 from waveshare import DisplayImage
+from waveshare import SetPallet
+from waveshare import CostModel
+from waveshare import calibrate
+from waveshare import EPaper
+from waveshare import SetEnFontSize
+from waveshare import DrawRectangle
+from waveshare import FillRectangle
+from waveshare.widgets import TextField
+from waveshare.buffer import CommandBuffer
+from waveshare.__main__ import Batcher
+from waveshare.__main__ import parse
+from waveshare.__main__ import to_command
+try:
+    import numpy
+    from waveshare import convert
+except ImportError:
+    convert = None
+from waveshare.daemon import FrameParser
+from waveshare.daemon import RenderQueue
+from waveshare.daemon import RenderDaemon
 
 MISMATCH = u"Values didn't match: \nactual:   %s \nexpected: %s"
 
@@ -156,6 +184,18 @@ class TestCommandSerialization(unittest.TestCase):
             'A5 00 15 29 00 0A 00 0A 00 20 00 80 00 80 00 FF CC 33 C3 3C 46',
             FillTriangle(0x0a, 0x0a, 0x20, 0x80, 0x80, 0xff))
 
+    def test_draw_rectangle(self):
+        ''' Draw rectangle should serialize to A5 00 11 25 00 0A 00 0A 00 FF 00 FF CC 33 C3 3C 91. '''
+        self.wrapper(
+            'A5 00 11 25 00 0A 00 0A 00 FF 00 FF CC 33 C3 3C 91',
+            DrawRectangle(0x0a, 0x0a, 0xff, 0xff))
+
+    def test_fill_rectangle(self):
+        ''' Fill rectangle should serialize to A5 00 11 24 00 0A 00 0A 00 FF 00 FF CC 33 C3 3C 90. '''
+        self.wrapper(
+            'A5 00 11 24 00 0A 00 0A 00 FF 00 FF CC 33 C3 3C 90',
+            FillRectangle(0x0a, 0x0a, 0xff, 0xff))
+
     def test_clear_screen(self):
         ''' Clear screen should serialize to A5 00 09 2E CC 33 C3 3C 82. '''
         self.wrapper(
@@ -174,7 +214,522 @@ class TestCommandSerialization(unittest.TestCase):
             'A5 00 16 70 00 00 00 00 50 49 43 37 2E 42 4D 50 00 CC 33 C3 3C DF',
             DisplayImage(0, 0, 'PIC7.BMP'))
 
+class TestRenderQueue(unittest.TestCase):
+    '''
+    Tests for splitting and merging the frames sent to the render daemon.
+    '''
+
+    def test_parser_splits_frames(self):
+        ''' Frames written back to back should be split apart again, even when they arrive in pieces. '''
+        first, second = Handshake().encode(), DrawCircle(1, 2, 3).encode()
+        parser = FrameParser()
+        self.assertEqual([first], parser.feed(first + second[:5]))
+        self.assertEqual([second], parser.feed(second[5:]))
+
+    def test_parser_skips_garbage(self):
+        ''' Bytes that aren't part of a valid frame should be dropped. '''
+        frame = ClearScreen().encode()
+        self.assertEqual([frame], FrameParser().feed(b'junk\xa5\xff' + frame))
+
+    def test_repeated_drawing_replaced(self):
+        ''' Drawing exactly the same thing twice should only be sent once, in the later position. '''
+        queue = RenderQueue()
+        queue.add(DrawCircle(10, 10, 5).encode())
+        queue.add(SetPallet().encode())
+        queue.add(DrawCircle(10, 10, 5).encode())
+        data, refresh = queue.drain()
+        self.assertEqual(SetPallet().encode() + DrawCircle(10, 10, 5).encode(), data)
+        self.assertFalse(refresh)
+
+    def test_repeated_drawing_other_font_kept(self):
+        ''' The same text in another font size draws something else, so both copies should be sent. '''
+        queue = RenderQueue()
+        commands = [SetEnFontSize(SetEnFontSize.SIXTYFOUR), DisplayText(0, 0, b'88'), SetEnFontSize(SetEnFontSize.THIRTYTWO), DisplayText(0, 0, b'88')]
+        for command in commands:
+            queue.add(command.encode())
+        self.assertEqual(b''.join(_.encode() for _ in commands), queue.drain()[0])
+
+    def test_same_position_text_kept(self):
+        ''' Shorter text at the same position doesn't cover longer text, so both should be sent. '''
+        queue = RenderQueue()
+        queue.add(DisplayText(10, 20, b'12:00').encode())
+        queue.add(FillRectangle(10, 20, 25, 51).encode())
+        queue.add(DisplayText(10, 20, b'2').encode())
+        expected = DisplayText(10, 20, b'12:00').encode() + FillRectangle(10, 20, 25, 51).encode() + DisplayText(10, 20, b'2').encode()
+        self.assertEqual(expected, queue.drain()[0])
+
+    def test_clear_drops_drawing(self):
+        ''' Drawing queued before a clear screen should be dropped. '''
+        queue = RenderQueue()
+        queue.add(FillCircle(5, 5, 5).encode())
+        queue.add(ClearScreen().encode())
+        self.assertEqual(ClearScreen().encode(), queue.drain()[0])
+
+    def test_client_reset_dropped(self):
+        ''' A client whose connection fails should be dropped without affecting the daemon. '''
+        class BrokenClient(object):
+            ''' A client socket whose connection was reset. '''
+            closed = False
+            def recv(self, size):
+                ''' Fail like a reset connection. '''
+                raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+            def close(self):
+                ''' Remember being closed. '''
+                self.closed = True
+        daemon = RenderDaemon(None)
+        client = BrokenClient()
+        daemon.clients[client] = FrameParser()
+        daemon._receive(client) #pylint: disable=protected-access
+        self.assertEqual({}, daemon.clients)
+        self.assertTrue(client.closed)
+
+    def test_client_settings_restored(self):
+        ''' A client's palette should be set again before its drawing when another client changed it in between. '''
+        class Client(object):
+            ''' A client socket that has sent some data. '''
+            def __init__(self):
+                self.data = b''
+            def recv(self, size):
+                ''' Return what was sent. '''
+                data, self.data = self.data, b''
+                return data
+        daemon = RenderDaemon(None)
+        first, second = Client(), Client()
+        daemon.clients[first] = FrameParser()
+        daemon.clients[second] = FrameParser()
+        ours, theirs = SetPallet(SetPallet.DARK_GRAY), SetPallet(SetPallet.WHITE, SetPallet.BLACK)
+        for client, command in [(first, ours), (second, theirs), (first, DisplayText(0, 0, b'A')), (first, DisplayText(0, 40, b'B'))]:
+            client.data = command.encode()
+            daemon._receive(client) #pylint: disable=protected-access
+        expected = ours.encode() + theirs.encode() + ours.encode() + DisplayText(0, 0, b'A').encode() + DisplayText(0, 40, b'B').encode()
+        self.assertEqual(expected, daemon.queue.drain()[0])
+
+    def test_refreshes_batched(self):
+        ''' Refreshes shouldn't be queued as frames, just flagged once for the batch. '''
+        queue = RenderQueue()
+        queue.add(RefreshAndUpdate().encode())
+        queue.add(DrawCircle(1, 1, 1).encode())
+        queue.add(RefreshAndUpdate().encode())
+        self.assertEqual((DrawCircle(1, 1, 1).encode(), True), queue.drain())
+
+class TestCostModel(unittest.TestCase):
+    '''
+    Tests for the cost estimates and the dry run mode that uses them.
+    '''
+
+    def test_wire_time(self):
+        ''' A handshake is 9 bytes, which is 90 bits on the wire, so at 9000 baud it should take 10ms. '''
+        report = CostModel(9000, {Handshake.COMMAND: 0.5}).estimate([Handshake()])
+        self.assertEqual(9, report.bytes)
+        self.assertAlmostEqual(0.01, report.wire_time)
+        self.assertAlmostEqual(0.5, report.device_time)
+        self.assertAlmostEqual(0.51, report.total_time)
+
+    def test_refreshes_counted(self):
+        ''' Every refresh in the sequence should be counted. '''
+        report = CostModel().estimate([ClearScreen(), RefreshAndUpdate(), DrawCircle(1, 1, 1), RefreshAndUpdate()])
+        self.assertEqual(4, report.commands)
+        self.assertEqual(2, report.refreshes)
+
+    def test_dry_run(self):
+        ''' A dry run EPaper should add up what it was asked to send, including automatic refreshes. '''
+        paper = EPaper('/dev/null', auto=True, dry_run=True)
+        paper.send(ClearScreen())
+        paper.send(DisplayText(0, 0, b'Hi'))
+        self.assertEqual(4, paper.cost.commands)
+        self.assertEqual(2, paper.cost.refreshes)
+        self.assertEqual(b'', paper.read())
+
+    def test_bad_frames_rejected(self):
+        ''' Frames with a length too short or running past the end of the data should be rejected rather than loop forever. '''
+        paper = EPaper('/dev/null', dry_run=True)
+        for data in [b'\xa5\x00\x00\x00', b'\xa5\x00\x00\x00' + b'\x00' * 8, Handshake().encode()[:-1], Handshake().encode() + b'\xa5\x00\x20' + b'\x00' * 10]:
+            self.assertRaises(ValueError, paper.write, data)
+
+    def test_calibrate(self):
+        ''' Calibrating should time each kind of command until its reply, and fail when a reply isn't "OK". '''
+        class SlowRefreshSerial(FakeSerial):
+            ''' Takes a while to answer a refresh. '''
+            def read(self, size):
+                ''' Wait before answering a refresh. '''
+                if self.written[-1] == RefreshAndUpdate().encode():
+                    time.sleep(0.05)
+                return FakeSerial.read(self, size)
+        paper = EPaper('/dev/null', dry_run=True)
+        paper.dry_run = False
+        paper.serial = SlowRefreshSerial([b'OK'] * 3)
+        times = calibrate(paper, [ClearScreen(), RefreshAndUpdate(), ClearScreen()])
+        self.assertEqual(sorted([ClearScreen.COMMAND, RefreshAndUpdate.COMMAND]), sorted(times))
+        self.assertTrue(times[RefreshAndUpdate.COMMAND] >= 0.04)
+        self.assertTrue(times[ClearScreen.COMMAND] < times[RefreshAndUpdate.COMMAND])
+        paper.serial = FakeSerial([b'OK', b''])
+        self.assertRaises(IOError, calibrate, paper, [ClearScreen(), ClearScreen()])
+
+class FakeSerial(object):
+    '''
+    Stands in for the serial device, recording writes and playing back
+    canned replies.
+    '''
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.written = []
+
+    def write(self, data):
+        ''' Record the written data. '''
+        self.written.append(data)
+
+    def read(self, size):
+        ''' Return the next canned reply, or nothing like a timed out read. '''
+        return self.replies.pop(0) if self.replies else b''
+
+    def flushInput(self): #pylint: disable=invalid-name
+        ''' Nothing is buffered. '''
+
+class SlowSerial(FakeSerial):
+    '''
+    Answers every handshake with "OK", but the first read only gets the
+    first byte of it, like a read that timed out mid reply.
+    '''
+
+    def __init__(self):
+        super(SlowSerial, self).__init__([])
+        self.buffer = b''
+
+    def write(self, data):
+        ''' Record the written data and queue the reply. '''
+        super(SlowSerial, self).write(data)
+        self.buffer += b'OK'
+
+    def read(self, size):
+        ''' Return what's buffered, only one byte the first time. '''
+        if not self.written[1:]:
+            size = 1
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def flushInput(self): #pylint: disable=invalid-name
+        ''' Throw away buffered input. '''
+        self.buffer = b''
+
+class TestJournal(unittest.TestCase):
+    '''
+    Tests for keeping the journal and recovering from errors with it.
+    '''
+
+    def paper(self, replies, journal=10):
+        '''
+        Makes an EPaper that talks to a FakeSerial with the given replies.
+        '''
+        paper = EPaper('/dev/null', dry_run=True, journal=journal)
+        paper.dry_run = False
+        paper.serial = FakeSerial(replies)
+        return paper
+
+    def test_refresh_empties_journal(self):
+        ''' Once a refresh is acknowledged the journal should be empty, keeping the state that was set. '''
+        paper = self.paper([b'OK', b'OK', b'OK'])
+        paper.send(SetEnFontSize(SetEnFontSize.SIXTYFOUR))
+        paper.send(DisplayText(0, 0, b'Hi'))
+        paper.update()
+        paper.sync()
+        self.assertEqual(0, len(paper.journal))
+        self.assertEqual([SetEnFontSize.COMMAND], list(paper.state))
+
+    def test_resend_unacknowledged(self):
+        ''' When a reply goes missing only the commands after the last acknowledged one should be resent. '''
+        paper = self.paper([b'OK', b'', b'OK', b'OK', b'OK'])
+        commands = [ClearScreen(), DrawCircle(1, 1, 1), DrawCircle(2, 2, 2)]
+        for command in commands:
+            paper.send(command)
+        paper.sync()
+        resent = paper.serial.written[len(commands):]
+        self.assertEqual([Handshake().encode(), commands[1].encode(), commands[2].encode()], resent)
+
+    def test_resend_restores_state(self):
+        ''' Commands resent after a handshake should be drawn with the settings they were first sent with. '''
+        paper = self.paper([b'OK', b'', b'OK', b'OK', b'OK', b'OK', b'OK'])
+        commands = [SetPallet(SetPallet.BLACK), DrawCircle(1, 1, 1), SetPallet(SetPallet.LIGHT_GRAY), DrawCircle(2, 2, 2)]
+        for command in commands:
+            paper.send(command)
+        paper.sync()
+        resent = paper.serial.written[len(commands):]
+        restored = [SetPallet(SetPallet.BLACK)]
+        self.assertEqual([Handshake().encode()] + [_.encode() for _ in restored + commands[1:]], resent)
+
+    def test_failed_restore_retried(self):
+        ''' When a restored setting isn't acknowledged nothing should be resent with it, recovery should be tried again instead. '''
+        paper = self.paper([b'OK', b'', b'OK', b'ER', b'OK', b'OK', b'OK', b'OK', b'OK'])
+        commands = [SetPallet(SetPallet.BLACK), DrawCircle(1, 1, 1), SetPallet(SetPallet.LIGHT_GRAY), DrawCircle(2, 2, 2)]
+        for command in commands:
+            paper.send(command)
+        paper.sync()
+        resent = paper.serial.written[len(commands):]
+        expected = [Handshake(), SetPallet(SetPallet.BLACK), Handshake(), SetPallet(SetPallet.BLACK)] + commands[1:]
+        self.assertEqual([_.encode() for _ in expected], resent)
+
+    def test_retries_are_consecutive(self):
+        ''' Failures separated by an acknowledgement shouldn't add up towards the retry limit. '''
+        paper = self.paper([b'', b'OK', b'OK', b'', b'OK', b'OK'])
+        paper.send(DrawCircle(1, 1, 1))
+        paper.send(DrawCircle(2, 2, 2))
+        paper.sync(retries=1)
+        self.assertEqual(len(paper.journal), paper.acknowledged)
+
+    def test_truncated_journal(self):
+        ''' Recovery should give up if the commands it needs were dropped. '''
+        paper = self.paper([b'', b''], journal=1)
+        paper.send(DrawCircle(1, 1, 1))
+        paper.send(DrawCircle(2, 2, 2))
+        self.assertRaises(IOError, paper.sync)
+
+    def test_wait_ready(self):
+        ''' Waiting for the display should keep handshaking until it answers. '''
+        paper = self.paper([b'', b'', b'OK'])
+        self.assertTrue(paper.wait_ready(timeout=1) < 1)
+        self.assertEqual([Handshake().encode()] * 3, paper.serial.written)
+
+    def test_wait_ready_partial_reply(self):
+        ''' A reply cut short by a timed out read shouldn't throw later replies out of step. '''
+        paper = self.paper([])
+        paper.serial = SlowSerial()
+        paper.wait_ready(timeout=1)
+        self.assertEqual(2, len(paper.serial.written))
+
+    def test_wait_ready_timeout(self):
+        ''' Waiting for a display that never answers should give up. '''
+        self.assertRaises(IOError, self.paper([]).wait_ready, 0.05)
+
+class TestTextField(unittest.TestCase):
+    '''
+    Tests that text fields only redraw what changed.
+    '''
+
+    def test_first_update_draws_everything(self):
+        ''' The first update should draw all of the text. '''
+        commands = TextField(10, 20).update(u'12:00')
+        self.assertEqual(repr(DisplayText(10, 20, b'12:00')), repr(commands[-1]))
+
+    def test_one_digit_changed(self):
+        ''' Changing the last digit should only erase and redraw that digit. '''
+        field = TextField(10, 20)
+        field.update(u'12:00')
+        commands = field.update(u'12:01')
+        self.assertEqual(repr(FillRectangle(74, 20, 89, 51)), repr(commands[1]))
+        self.assertEqual(repr(DisplayText(74, 20, b'1')), repr(commands[-1]))
+        self.assertEqual(6, len(commands))
+
+    def test_shorter_text_erased(self):
+        ''' Characters that are no longer there should be erased but nothing drawn in their place. '''
+        field = TextField(0, 0)
+        field.update(u'100')
+        commands = field.update(u'99')
+        self.assertEqual(repr(FillRectangle(0, 0, 47, 31)), repr(commands[1]))
+        self.assertEqual(repr(DisplayText(0, 0, b'99')), repr(commands[-1]))
+
+    def test_unchanged(self):
+        ''' Nothing should be sent when the text didn't change. '''
+        field = TextField(0, 0)
+        field.update(u'same')
+        self.assertEqual([], field.update(u'same'))
+
+class TestCommandBuffer(unittest.TestCase):
+    '''
+    Tests that commands stored in a CommandBuffer encode the same as Command
+    objects.
+    '''
+
+    def test_encodes_like_commands(self):
+        ''' The whole buffer should encode to the same bytes as the equivalent commands. '''
+        commands = CommandBuffer()
+        commands.clear()
+        commands.pallet(SetPallet.DARK_GRAY)
+        commands.text(10, 10, u'你好World'.encode('gb2312'))
+        commands.circle(5, 5, 10, fill=True)
+        commands.triangle(0x0a, 0x0a, 0x20, 0x80, 0x80, 0xff)
+        commands.append(DisplayImage(0, 0, 'PIC7.BMP'))
+        commands.refresh()
+        expected = [ClearScreen(), SetPallet(SetPallet.DARK_GRAY), DisplayText(10, 10, u'你好World'.encode('gb2312')), FillCircle(5, 5, 10), DrawTriangle(0x0a, 0x0a, 0x20, 0x80, 0x80, 0xff), DisplayImage(0, 0, 'PIC7.BMP'), RefreshAndUpdate()]
+        self.assertEqual(b''.join([_.encode() for _ in expected]), commands.encode().tobytes())
+        self.assertEqual([repr(_) for _ in expected], [repr(_) for _ in commands])
+
+    def test_bounding_boxes(self):
+        ''' Drawing commands should get bounding boxes, clamped to the screen, that can be searched. '''
+        commands = CommandBuffer()
+        commands.pallet()
+        commands.circle(5, 5, 10)
+        commands.text(100, 100, b'Hi', SetEnFontSize.SIXTYFOUR)
+        self.assertEqual((0, 0, 15, 15), commands[1].bbox)
+        self.assertEqual((100, 100, 163, 163), commands[2].bbox)
+        self.assertEqual([1], commands.intersecting(0, 0, 50, 50))
+        self.assertEqual(DrawCircle.COMMAND, commands[-2].command)
+
+    def test_appended_boxes(self):
+        ''' Commands added as objects should get the same bounding boxes as when added by what they draw. '''
+        commands = CommandBuffer()
+        commands.append(SetPallet())
+        commands.append(FillCircle(100, 100, 10))
+        commands.append(DisplayText(10, 10, b'Hi'), SetEnFontSize.FOURTYEIGHT)
+        commands.append(DisplayImage(0, 0, b'PIC7.BMP'))
+        commands.append(DrawRectangle(30, 40, 10, 20))
+        self.assertEqual([None, (90, 90, 110, 110), (10, 10, 57, 57), (0, 0, 0, 0), (10, 20, 30, 40)], [_.bbox for _ in commands])
+        self.assertEqual([1], commands.intersecting(95, 95, 96, 96))
+        self.assertEqual(FillCircle(100, 100, 10).encode(), commands[1].encode().tobytes())
+
+    def test_encode_without_copying(self):
+        ''' Encoding should give a view of the stored frames, for the whole buffer or part of it. '''
+        commands = CommandBuffer()
+        commands.clear()
+        commands.circle(5, 5, 5)
+        commands.refresh()
+        encoded = commands.encode(1, 3)
+        self.assertTrue(isinstance(encoded, memoryview))
+        self.assertEqual(DrawCircle(5, 5, 5).encode() + RefreshAndUpdate().encode(), encoded.tobytes())
+        del encoded
+        commands.clear()
+        self.assertEqual(b''.join([_.encode() for _ in [ClearScreen(), DrawCircle(5, 5, 5), RefreshAndUpdate(), ClearScreen()]]), commands.encode().tobytes())
+
+    def test_drawing_at_origin(self):
+        ''' Drawing at the very top left should still be found, but commands that don't draw shouldn't be. '''
+        commands = CommandBuffer()
+        commands.clear()
+        commands.image(0, 0, b'PIC7.BMP')
+        commands.circle(0, 0, 0)
+        self.assertEqual(None, commands[0].bbox)
+        self.assertEqual((0, 0, 0, 0), commands[1].bbox)
+        self.assertEqual([1, 2], commands.intersecting(0, 0, 799, 599))
+
+class FakePaper(object):
+    '''
+    Records what is written to it, standing in for an EPaper.
+    '''
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        ''' Record the written data. '''
+        self.written.append(data)
+
+    def update(self):
+        ''' Record a refresh. '''
+        self.written.append(RefreshAndUpdate().encode())
+
+class TestCommandLine(unittest.TestCase):
+    '''
+    Tests for reading drawing operations and batching them.
+    '''
+
+    def commands(self, line):
+        '''
+        Returns the encoded commands for a line of input.
+        '''
+        return [_.encode() for _ in to_command(*parse(line))]
+
+    def test_lines_and_json(self):
+        ''' Plain and JSON lines should make the same commands. '''
+        self.assertEqual([DisplayText(10, 20, b'Hello World').encode()], self.commands('text 10 20 Hello World'))
+        self.assertEqual([DisplayText(10, 20, b'Hello World').encode()], self.commands('{"op": "text", "x": 10, "y": 20, "text": "Hello World"}'))
+        self.assertEqual([FillCircle(1, 2, 3).encode()], self.commands('fill-circle 1 2 3'))
+        self.assertEqual([SetPallet(SetPallet.DARK_GRAY).encode()], self.commands('{"op": "palette", "fg": "dark-gray"}'))
+        self.assertEqual([SetEnFontSize(SetEnFontSize.SIXTYFOUR).encode()], self.commands('font 64 en'))
+        self.assertEqual(None, parse('  # comment'))
+
+    def test_bad_lines(self):
+        ''' Unknown operations and wrong arguments should be rejected. '''
+        self.assertRaises(ValueError, parse, 'square 1 2 3')
+        self.assertRaises(ValueError, to_command, 'circle', ['1', '2'])
+        self.assertRaises(ValueError, to_command, 'palette', ['purple'])
+        self.assertRaises(ValueError, to_command, 'font', ['12'])
+
+    def test_bad_json_fields(self):
+        ''' JSON lines with missing or wrongly typed fields should be rejected, not crash. '''
+        for line in [
+                '{"op": "circle", "x": 1, "radius": 3}',
+                '{"op": "text", "x": 1, "y": 2, "text": 5}',
+                '{"op": "circle", "x": [1], "y": 2, "radius": 3}',
+                '{"op": "palette", "fg": ["black"]}',
+                '{"op": "font", "size": {}}',
+                '{"op": "font", "size": 32, "lang": ["en"]}',
+                '{"op": ["text"], "x": 1, "y": 2, "text": "Hi"}',
+                '{"op": {}}',
+                '[{"op": "clear"}]',
+                '{"op": "text", "x": 1, "y": 2, "text": ""}',
+                'text 1 2',
+        ]:
+            self.assertRaises(ValueError, lambda: to_command(*parse(line))) #pylint: disable=cell-var-from-loop
+
+    def test_batching(self):
+        ''' Commands should be written a batch at a time, and refreshes only sent when something changed. '''
+        paper = FakePaper()
+        batcher = Batcher(paper, 2)
+        for command in [ClearScreen(), DrawCircle(1, 1, 1), DrawCircle(2, 2, 2), RefreshAndUpdate(), RefreshAndUpdate()]:
+            batcher.add(command)
+        batcher.refresh()
+        expected = [ClearScreen().encode() + DrawCircle(1, 1, 1).encode(), DrawCircle(2, 2, 2).encode(), RefreshAndUpdate().encode()]
+        self.assertEqual(expected, paper.written)
+
+    def test_settings_alone_not_refreshed(self):
+        ''' Changing the palette or font without drawing should write the commands but not refresh. '''
+        paper = FakePaper()
+        batcher = Batcher(paper)
+        for command in [SetPallet(SetPallet.WHITE, SetPallet.BLACK), SetEnFontSize(SetEnFontSize.FOURTYEIGHT)]:
+            batcher.add(command)
+        batcher.refresh()
+        self.assertEqual([SetPallet(SetPallet.WHITE, SetPallet.BLACK).encode() + SetEnFontSize(SetEnFontSize.FOURTYEIGHT).encode()], paper.written)
+
+@unittest.skipIf(convert is None, 'converting images needs numpy and PIL')
+class TestConvert(unittest.TestCase):
+    '''
+    Tests for turning images into bitmaps for the display.
+    '''
 
+    def setUp(self):
+        self.staging = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.staging)
+
+    def test_write_bmp(self):
+        ''' Bitmaps should have 2 bits per pixel, the four grays as palette, rows padded to 4 bytes and stored bottom up. '''
+        indexes = numpy.array([[0, 1, 2, 3, 3], [3, 2, 1, 0, 0], [1, 1, 1, 1, 2]], numpy.uint8)
+        path = os.path.join(self.staging, 'TEST.BMP')
+        convert.write_bmp(indexes, path)
+        with open(path, 'rb') as bitmap:
+            data = bitmap.read()
+        magic, size, _, _, offset = struct.unpack('<2sIHHI', data[:14])
+        header, width, height, planes, bits, compression, _, _, _, colors, _ = struct.unpack('<IiiHHIIiiII', data[14:54])
+        self.assertEqual((b'BM', len(data), 70), (magic, size, offset))
+        self.assertEqual((40, 5, 3, 1, 2, 0, 4), (header, width, height, planes, bits, compression, colors))
+        self.assertEqual(b'\x00\x00\x00\x00\x55\x55\x55\x00\xaa\xaa\xaa\x00\xff\xff\xff\x00', data[54:70])
+        self.assertEqual(b'\x55\x80\x00\x00' + b'\xe4\x00\x00\x00' + b'\x1b\xc0\x00\x00', data[70:])
+
+    def test_bitmap_name(self):
+        ''' Bitmap names should be uppercase and short enough for the display. '''
+        for fingerprint in ['0', 'f' * 40, '0123456789abcdef' * 2]:
+            name = convert.bitmap_name(fingerprint)
+            self.assertTrue(re.match(r'^[0-9A-Z]+\.BMP$', name), name)
+            self.assertTrue(len(name) <= 10, name)
+
+    def test_dither_flat_grays(self):
+        ''' Each of the display's grays should stay exactly that gray, and one between two should mix them. '''
+        for index, gray in enumerate(convert.GRAYS):
+            self.assertTrue((convert.dither_ordered(numpy.full((8, 8), gray, numpy.float64)) == index).all())
+        mixed = convert.dither_ordered(numpy.full((8, 8), 0x80, numpy.float64))
+        self.assertEqual(set([1, 2]), set(mixed.flatten().tolist()))
+
+    def test_cache_reused(self):
+        ''' Converting the same image again should reuse the bitmap instead of writing it again. '''
+        image = numpy.zeros((30, 40), numpy.uint8)
+        name = convert.convert(image, self.staging)
+        path = os.path.join(self.staging, name)
+        with open(path, 'wb') as bitmap:
+            bitmap.write(b'cached')
+        self.assertEqual(name, convert.convert(image.copy(), self.staging))
+        with open(path, 'rb') as bitmap:
+            self.assertEqual(b'cached', bitmap.read())
+        self.assertNotEqual(name, convert.convert(image, self.staging, convert.DIFFUSION))
+        self.assertEqual(sorted(os.listdir(self.staging)), sorted([name, convert.convert(image, self.staging, convert.DIFFUSION)]))
 
 
 def main():
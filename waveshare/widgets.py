@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Widgets that work out the commands needed to update part of the display.
+
+Widgets don't talk to the display themselves, they return lists of commands
+for the caller to send (to an EPaper, a RenderClient, or anything else with a
+send method).
+'''
+
+#pylint: disable=line-too-long
+
+from waveshare import DisplayText
+from waveshare import FillRectangle
+from waveshare import SetEnFontSize
+from waveshare import SetFontSize
+from waveshare import SetPallet
+from waveshare import SetZhFontSize
+
+def glyph_advance(char, size=SetFontSize.THIRTYTWO):
+    '''
+    Returns how many pixels the display moves right after drawing char (a
+    unicode character) at the given font size.  English (ASCII) characters
+    are half as wide as they are tall, everything else is square.
+    '''
+    pixels = SetFontSize.PIXELS[size]
+    if ord(char) < 0x80:
+        return pixels // 2
+    return pixels
+
+class TextField(object):
+    '''
+    A line of text that is redrawn by only replacing the characters that
+    changed, for things like clocks and counters.  For example:
+
+        clock = TextField(10, 10)
+        for command in clock.update(u'12:00'):
+            paper.send(command)
+        ...
+        for command in clock.update(u'12:01'):
+            paper.send(command)
+
+    The second update erases and redraws only the last digit.
+    '''
+
+    # Unchanged characters between two changed ones are redrawn anyway if
+    # there are at most this many of them, that costs less than the extra
+    # erase and text commands needed to skip them.
+    MERGE_GAP = 8
+
+    def __init__(self, x, y, size=SetFontSize.THIRTYTWO, fg=SetPallet.BLACK, bg=SetPallet.WHITE, encoding='gb2312'):
+        '''
+        @param x The left edge of the text.
+        @param y The top edge of the text.
+        @param size The font size (one of the SetFontSize sizes), for both English and Chinese characters.
+        @param fg The color of the text.
+        @param bg The color to erase with.
+        @param encoding What to encode the text with for the display.
+        '''
+        self.x = x
+        self.y = y
+        self.size = size
+        self.fg = fg
+        self.bg = bg
+        self.encoding = encoding
+        self.text = u''
+
+    def cells(self, text):
+        '''
+        Returns a list of (x, width) for every character of text.
+        '''
+        cells = []
+        x = self.x
+        for char in text:
+            width = glyph_advance(char, self.size)
+            cells.append((x, width))
+            x += width
+        return cells
+
+    def spans(self, old, new):
+        '''
+        Returns a list of (start, end) index ranges of characters that differ
+        between old and new, either in content or in position.
+        '''
+        old_cells, new_cells = self.cells(old), self.cells(new)
+        spans = []
+        for index in range(max(len(old), len(new))):
+            if index < len(old) and index < len(new) and old[index] == new[index] and old_cells[index] == new_cells[index]:
+                continue
+            if spans and index - spans[-1][1] <= self.MERGE_GAP:
+                spans[-1] = (spans[-1][0], index + 1)
+            else:
+                spans.append((index, index + 1))
+        return spans
+
+    def update(self, text):
+        '''
+        Change the text to the given (unicode) string and return the commands
+        that redraw the characters that changed.  Nothing is returned if the
+        text is unchanged.
+        '''
+        old, self.text = self.text, text
+        spans = self.spans(old, text)
+        if not spans:
+            return []
+        old_cells, new_cells = self.cells(old), self.cells(text)
+        height = SetFontSize.PIXELS[self.size]
+        erase = [SetPallet(self.bg, self.bg)]
+        draw = [SetPallet(self.fg, self.bg), SetEnFontSize(self.size), SetZhFontSize(self.size)]
+        for start, end in spans:
+            cells = old_cells[start:end] + new_cells[start:end]
+            left = min(x for x, _ in cells)
+            right = max(x + width for x, width in cells)
+            erase.append(FillRectangle(left, self.y, right - 1, self.y + height - 1))
+            if start < len(text):
+                draw.append(DisplayText(new_cells[start][0], self.y, text[start:end].encode(self.encoding)))
+        return erase + draw